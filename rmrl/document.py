@@ -14,7 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import gc
+import io
 import json
 import logging
 
@@ -31,26 +31,90 @@ from .pens.highlighter import HighlighterPen
 
 log = logging.getLogger(__name__)
 
+# v6 points are measured from the horizontal center of the page, so
+# shift them right by half the page width; they are also shifted up by
+# half the page height. The widths are scaled down by a fixed factor.
+# TODO how to get the correct transformations?
+V6_XOFFSET = DISPLAY['screenwidth'] / 2.0
+V6_YOFFSET = -DISPLAY['screenheight'] / 2.0
+V6_WIDTHSCALE = 0.25
+
+def _points_to_segments(points: list[Point]) -> list[Segment]:
+    # Convert the points of a v6 stroke into segments in page coordinates.
+    # This runs for every point of every stroke, so keep it a single
+    # comprehension instead of a function call per point.
+    return [Segment(p.x + V6_XOFFSET, p.y + V6_YOFFSET, p.speed,
+                    p.direction, p.width * V6_WIDTHSCALE, p.pressure)
+            for p in points]
+
+class TemplateCache:
+    # The templates used while rendering a single document. Most pages
+    # of a notebook share a template, so each is only looked up and
+    # parsed once. Create a new cache for every render, so that changed
+    # or newly installed templates are picked up.
+
+    def __init__(self):
+        self.paths = {}
+        self.drawings = {}
+
+    def find(self, template_name):
+        # Return the path of the SVG for a template, or None if it is
+        # blank or not installed.
+        if template_name not in self.paths:
+            template_path = TEMPLATE_PATH / f'{template_name}.svg'
+            if template_name != 'Blank' and template_path.exists():
+                self.paths[template_name] = str(template_path)
+            else:
+                self.paths[template_name] = None
+        return self.paths[template_name]
+
+    def load(self, path):
+        # The drawing is scaled here, as scale() composes with any
+        # previous transformation; renderPDF.draw does not modify it.
+        background = self.drawings.get(path)
+        if background is None:
+            background = svg2rlg(path)
+            background.scale(PDFWIDTH / background.width,
+                             PDFWIDTH / background.width)
+            self.drawings[path] = background
+        return background
+
+def read_template_names(source):
+    # The templates of all pages of a v3 or v5 notebook, one per line
+    pagedatapath = '{ID}.pagedata'
+    if not source.exists(pagedatapath):
+        return []
+    with source.open(pagedatapath, 'r') as f:
+        return f.read().splitlines()
+
 class DocumentPage:
     # A single page in a document
-    def __init__(self, source, pid, pagenum, template_name = None):
+    def __init__(self, source, pid, pagenum, template_name = None,
+                 template_names = None, templates = None):
         # Page 0 is the first page!
         self.source = source
         self.num = pagenum
+        self.templates = templates if templates is not None else TemplateCache()
 
         pidhighlights = pid
 
         # On disk, these files are named by a UUID
         self.rmpath = f'{{ID}}/{pid}.rm'
-        if not source.exists(self.rmpath):
+        rm_exists = source.exists(self.rmpath)
+        if not rm_exists:
             # From the API, these files are just numbered, however the
             # json file for the highlights still uses the UUID-style pid.
             pid = str(pagenum)
             self.rmpath = f'{{ID}}/{pid}.rm'
+            rm_exists = source.exists(self.rmpath)
 
-        if source.exists(self.rmpath):
+        # Read the .rm file only once into a buffer, which is rewound and
+        # parsed in full by load_layers.
+        self._rm_file = None
+        if rm_exists:
             with self.source.open(self.rmpath, 'rb') as f:
-                self.version = lines.getVersion(f)
+                self._rm_file = io.BytesIO(f.read())
+            self.version = lines.getVersion(self._rm_file)
         else:
             self.version = None
 
@@ -73,15 +137,12 @@ class DocumentPage:
         # v4 and v5
         ver = self.version
         if ver == 6:
-            template_path = TEMPLATE_PATH / f'{template_name}.svg'
-            if template_name != 'Blank' and template_path.exists():
-                self.template = str(template_path)
+            self.template = self.templates.find(template_name)
         else:
-            template_names = []
-            pagedatapath = '{ID}.pagedata'
-            if source.exists(pagedatapath):
-                with source.open(pagedatapath, 'r') as f:
-                    template_names = f.read().splitlines()
+            # The caller may pass in the .pagedata templates, so that the
+            # file needn't be read again for every page.
+            if template_names is None:
+                template_names = read_template_names(source)
 
             if template_names:
                 # I have encountered an issue with some PDF files, where the
@@ -91,11 +152,9 @@ class DocumentPage:
                 try:
                     template_name = template_names[self.num] # pages with different templates
                 except IndexError:
-                    template_name = template_name = [min(self.num, len(template_names) - 1)]
+                    template_name = template_names[-1]
 
-                template_path = TEMPLATE_PATH / f'{template_name}.svg'
-                if template_name != "Blank" and template_path.exists():
-                    self.template = str(template_path)
+                self.template = self.templates.find(template_name)
 
         # Load layers
         self.layers = []
@@ -117,23 +176,15 @@ class DocumentPage:
     def get_layers(self, source):
         blocks = read_blocks(source)
 
-        def to_segment(point: Point) -> Segment:
-            # TODO how to get the correct transformations?
-            return Segment(
-                x=point.x + 1404 / 2.0,
-                y=point.y - 1872 / 2.0,
-                speed=point.speed,
-                direction=point.direction,
-                width=point.width / 4.0,
-                pressure=point.pressure,
-            )
-
         layers = []
         current_layer = ""
         current_strokes = []
 
+        # Dispatch on the exact block type; neither of these is subclassed.
+        line_block, tree_block = SceneLineItemBlock, TreeNodeBlock
         for block in blocks:
-            if isinstance(block, SceneLineItemBlock):
+            block_type = type(block)
+            if block_type is line_block:
                 # import pprint
                 # print("block:")
                 # pprint.pprint(block)
@@ -148,48 +199,63 @@ class DocumentPage:
                 thickness_scale: float = block.value.thickness_scale
                 # starting_length: float = block.value.starting_length
 
-                segments = list(map(to_segment, points))
+                segments = _points_to_segments(points)
                 stroke = Stroke(tool, color, None, thickness_scale, None, segments)
                 current_strokes.append(stroke)
 
-            elif isinstance(block, TreeNodeBlock):
+            elif block_type is tree_block:
                 if current_layer == block.group.label.value:
                     continue
 
-                layers.append(Layer(current_strokes, current_layer))
+                if current_strokes or current_layer:
+                    layers.append(Layer(current_strokes, current_layer))
                 current_layer = block.group.label.value
                 current_strokes = []
             else:
-                print(f'warning: not converting block: {block.__class__}')
+                log.debug("not converting block: %s", block.__class__)
 
-        layers.append(Layer(current_strokes, current_layer))
-        current_strokes = []
+        if current_strokes or current_layer:
+            layers.append(Layer(current_strokes, current_layer))
 
-        return layers[1:]
+        return layers
 
     def load_layers(self):
         # Loads layers from the .rm files
 
-        if not self.source.exists(self.rmpath):
+        if self._rm_file is None:
             # no layers, obv
             return
 
         # Load reMy version of page layers
         pagelayers = None
-        with self.source.open(self.rmpath, 'rb') as f:
+        with self._rm_file as f:
+            f.seek(0)
             ver = self.version
             if ver == 6:
                 pagelayers = self.get_layers(f)
             else:
                 # handles unsupported versions
                 _, pagelayers = lines.readLines(f)
+        self._rm_file = None
 
         # Load page layers of highlights
         if self.highlightdict:
             _, pagelayershlght = lines.readHighlights(self.highlightdict)
-            
-            from operator import add
-            pagelayers = list(map(add, pagelayers, pagelayershlght))
+
+            for layer, hlstrokes in zip(pagelayers, pagelayershlght):
+                if ver == 6:
+                    layer = layer.strokes
+                layer.extend(hlstrokes)
+
+        # The layer names are all that is used from the page metadata.
+        # Malformed metadata falls back to the default names below.
+        layer_names = []
+        if ver != 6 and isinstance(self.metadict, dict):
+            metalayers = self.metadict.get('layers')
+            if isinstance(metalayers, list):
+                layer_names = [layer.get('name') if isinstance(layer, dict)
+                               else None
+                               for layer in metalayers]
 
         # Load layer data
         for i in range(0, len(pagelayers)):
@@ -197,9 +263,9 @@ class DocumentPage:
                 layerstrokes, layer_name = pagelayers[i]
             else:
                 layerstrokes = pagelayers[i]
-                try:
-                    layer_name = self.metadict['layers'][i]['name']
-                except:
+                if i < len(layer_names) and layer_names[i] is not None:
+                    layer_name = layer_names[i]
+                else:
                     layer_name = 'Layer ' + str(i+1)
 
             layer = DocumentPageLayer(self, name=layer_name)
@@ -210,8 +276,7 @@ class DocumentPage:
         # Render template layer
         if self.template:
             if template_alpha > 0:
-                background = svg2rlg(self.template)
-                background.scale(PDFWIDTH / background.width, PDFWIDTH / background.width)
+                background = self.templates.load(self.template)
                 renderPDF.draw(background, canvas, 0, 0)
                 if template_alpha < 1:
                     canvas.saveState()
@@ -219,14 +284,6 @@ class DocumentPage:
                     canvas.setFillAlpha(1 - template_alpha)
                     canvas.rect(0, 0, PDFWIDTH, PDFHEIGHT, fill=True, stroke=False)
                     canvas.restoreState()
-            # Bitmaps are rendered into the PDF as XObjects, which are
-            # easy to pick out for layers. Vectors will render
-            # everything inline, and so we need to add a 'magic point'
-            # to mark the end of the template layer.
-            if False and vector:  #TODO
-                pen = GenericPen(color=Qt.transparent, vector=vector)
-                painter.setPen(pen)
-                painter.drawPoint(800, 85)
 
         # The annotation coordinate system is upside down compared to the PDF
         # coordinate system, so offset the bottom to the top and then flip
@@ -236,14 +293,6 @@ class DocumentPage:
         canvas.scale(PTPERPX, -PTPERPX)
         # Render user layers
         for layer in self.layers:
-            # Bitmaps are rendered into the PDF as XObjects, which are
-            # easy to pick out for layers. Vectors will render
-            # everything inline, and so we need to add a 'magic point'
-            # to mark the beginning of layers.
-            if False and vector:  #TODO
-                pen = GenericPen(color=Qt.transparent, vector=vector)
-                painter.setPen(pen)
-                painter.drawPoint(420, 69)
             layer.render_to_painter(canvas, vector)
         canvas.showPage()
 
@@ -251,34 +300,34 @@ class DocumentPage:
 class DocumentPageLayer:
     pen_widths = []
 
+    # pen colors
+    colors = (
+        # Colors described as: name on rM (rendered color)
+        (56/255, 57/255, 56/255),    # black (very dark grey)
+        (0.5, 0.5, 0.5),             # grey  (light grey)
+        (1, 1, 1),                   # white (white)
+        (1, 1, 0),
+        (0, 1, 0),
+        (1, 0, 1),
+        (52/255, 120/255, 247/255),  # blue  (unnoticeably pastel blue)
+        (228/255, 95/255, 89/255)    # red   (slightly pinkish red)
+    )
+
+    # highlight colors
+    highlight_colors = (
+        # Colors described as: name on rM (rendered color)
+        (None, None, None),
+        (248/255, 241/255, 36/255),  # yellow (yellow)
+        (None, None, None),
+        (248/255, 241/255, 36/255),  # yellow (yellow)
+        (183/255, 248/255, 73/255),  # green  (yellowish green)
+        (248/255, 79/255, 145/255)   # pink   (reddish pink)
+    )
+
     def __init__(self, page, name=None):
         self.page = page
         self.name = name
 
-        # pen colors
-        self.colors = [
-            # Colors described as: name on rM (rendered color)
-            (56/255, 57/255, 56/255),    # black (very dark grey)
-            (0.5, 0.5, 0.5),             # grey  (light grey)
-            (1, 1, 1),                   # white (white)
-            (1, 1, 0),
-            (0, 1, 0),
-            (1, 0, 1),
-            (52/255, 120/255, 247/255),  # blue  (unnoticeably pastel blue)
-            (228/255, 95/255, 89/255)    # red   (slightly pinkish red)
-        ]
-        
-        # highlight colors
-        self.highlight_colors = [
-            # Colors described as: name on rM (rendered color)
-            (None, None, None),
-            (248/255, 241/255, 36/255),  # yellow (yellow)
-            (None, None, None),
-            (248/255, 241/255, 36/255),  # yellow (yellow)
-            (183/255, 248/255, 73/255),  # green  (yellowish green)
-            (248/255, 79/255, 145/255)   # pink   (reddish pink)
-        ]
-
         # Set this from the calling func
         self.strokes = None
 
@@ -289,107 +338,94 @@ class DocumentPageLayer:
     def get_grouped_annotations(self):
         # return: (LayerName, [(AnnotType, minX, minY, maxX, maxY)])
 
-        # Compare all the annot_paths to each other. If any overlap,
-        # they will be grouped together. This is done recursively.
-        def grouping_func(pathset):
-            newset = []
-
-            for p in pathset:
-                annotype = p[0]
-                path = p[1]
-                did_fit = False
-                for i, g in enumerate(newset):
-                    gannotype = g[0]
-                    group = g[1]
-                    # Only compare annotations of the same type
-                    if gannotype != annotype:
-                        continue
-                    if path.intersects(group):
-                        did_fit = True
-                        newset[i] = (annotype, group.united(path))
-                        break
-                if did_fit:
+        # Any annot_paths that overlap are grouped together, also
+        # transitively. Sweep over the paths ordered by their left edge,
+        # so that only paths whose bounding boxes overlap need to be
+        # compared, and merge the groups with a union-find.
+        paths = self.annot_paths
+        boxes = []
+        for annotype, path in paths:
+            rect = path.boundingRect()
+            boxes.append((float(rect.x()),
+                          float(rect.y()),
+                          float(rect.x() + rect.width()),
+                          float(rect.y() + rect.height())))
+
+        parent = list(range(len(paths)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        active = []
+        for i in sorted(range(len(paths)), key=lambda i: boxes[i][0]):
+            annotype, path = paths[i]
+            minx, miny, maxx, maxy = boxes[i]
+            # Forget the paths that end before this one starts
+            active = [j for j in active if boxes[j][2] >= minx]
+            for j in active:
+                # Only compare annotations of the same type
+                if paths[j][0] != annotype:
                     continue
-                # Didn't fit, so place into a new group
-                newset.append(p)
-
-            if len(newset) != len(pathset):
-                # Might have stuff left to group
-                return grouping_func(newset)
-            else:
-                # Nothing was grouped, so done
-                return newset
-
-        grouped = grouping_func(self.annot_paths)
+                if boxes[j][3] < miny or boxes[j][1] > maxy:
+                    continue
+                iroot, jroot = find(i), find(j)
+                if iroot != jroot and path.intersects(paths[j][1]):
+                    parent[iroot] = jroot
+            active.append(i)
 
         # Get the bounding rect of each group, which sets the PDF
         # annotation geometry.
-        annot_rects = []
-        for p in grouped:
-            annotype = p[0]
-            path = p[1]
-            rect = path.boundingRect()
-            annot = (annotype,
-                     float(rect.x()),
-                     float(rect.y()),
-                     float(rect.x() + rect.width()),
-                     float(rect.y() + rect.height()))
-            annot_rects.append(annot)
+        groups = {}
+        for i, (annotype, path) in enumerate(paths):
+            root = find(i)
+            minx, miny, maxx, maxy = boxes[i]
+            if root in groups:
+                _, gminx, gminy, gmaxx, gmaxy = groups[root]
+                groups[root] = (annotype,
+                                min(gminx, minx),
+                                min(gminy, miny),
+                                max(gmaxx, maxx),
+                                max(gmaxy, maxy))
+            else:
+                groups[root] = (annotype, minx, miny, maxx, maxy)
+        annot_rects = list(groups.values())
 
         return (self.name, annot_rects)
 
     def paint_strokes(self, canvas, vector):
+        # Most strokes in a layer share their pen and color, so only
+        # create one pen for each combination. The strokes are still
+        # painted in their original order.
+        qpens = {}
         for stroke in self.strokes:
             pen, color, unk1, width, unk2, segments = stroke
 
-            penclass = pens.PEN_MAPPING.get(pen)
-            if penclass is None:
-                log.error("Unknown pen code %d" % pen)
-                penclass = pens.GenericPen
-
-            # if pen is highlighter
-            elif penclass == HighlighterPen:
-                pencolor = self.highlight_colors[color]
-            # if pen is not highlighter
-            else:
-                pencolor = self.colors[color]
-
-            qpen = penclass(vector=vector,
-                            layer=self,
-                            color=pencolor)
+            qpen = qpens.get((pen, color))
+            if qpen is None:
+                penclass = pens.PEN_TUPLE[pen] if 0 <= pen < len(pens.PEN_TUPLE) else None
+                if penclass is None:
+                    log.error("Unknown pen code %d" % pen)
+                    penclass = pens.GenericPen
+
+                # if pen is highlighter
+                if penclass is HighlighterPen:
+                    pencolor = self.highlight_colors[color]
+                # if pen is not highlighter
+                else:
+                    pencolor = self.colors[color]
+
+                qpen = penclass(vector=vector,
+                                layer=self,
+                                color=pencolor)
+                qpens[(pen, color)] = qpen
 
             # Do the needful
             qpen.paint_stroke(canvas, stroke)
 
     def render_to_painter(self, painter, vector):
-        if vector: # Turn this on with vector otherwise off to get hybrid
-            self.paint_strokes(painter, vector=vector)
-            return
-
-        assert False
-
-        # I was having problems with QImage corruption (garbage data)
-        # and memory leaking on large notebooks. I fixed this by giving
-        # the QImage a reference array to pre-allocate RAM, then reset
-        # the reference count after I'm done with it, so that it gets
-        # cleaned up by the python garbage collector.
-
-        devpx = DISPLAY['screenwidth'] \
-            * DISPLAY['screenheight']
-        bytepp = 4  # ARGB32
-        qimage = QImage(b'\0' * devpx * bytepp,
-                        DISPLAY['screenwidth'],
-                        DISPLAY['screenheight'],
-                        QImage.Format_ARGB32)
-
-        imgpainter = QPainter(qimage)
-        imgpainter.setRenderHint(QPainter.Antialiasing)
-        #imgpainter.setRenderHint(QPainter.LosslessImageRendering)
-        self.paint_strokes(imgpainter, vector=vector)
-        imgpainter.end()
-
-        painter.drawImage(0, 0, qimage)
-
-        del imgpainter
-        del qimage
-        gc.collect()
+        if not vector:
+            raise NotImplementedError("raster rendering is not supported")
+        self.paint_strokes(painter, vector=vector)
@@ -36,3 +36,7 @@ PEN_MAPPING = dict(enumerate([
     None,                # unknown
     CalligraphyPen       # Calligraphy
 ]))
+
+# The pen codes are small integers, so also provide the mapping as a
+# tuple to index directly. Unknown codes map to None, as above.
+PEN_TUPLE = tuple(PEN_MAPPING.get(i) for i in range(max(PEN_MAPPING) + 1))
@@ -14,6 +14,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 import logging
 import tempfile
 from pathlib import Path
@@ -35,7 +38,8 @@ def render(source, *,
            progress_cb=lambda x: None,
            expand_pages=True,
            template_alpha=0.3,
-           only_annotated=False):
+           only_annotated=False,
+           prefetch_pages=0):
     """
     Render a source document as a PDF file.
 
@@ -59,6 +63,10 @@ def render(source, *,
                     makes the templates invisible, 1 makes them fully dark.
     only_annotated: Boolean value (default False) indicating whether only
                     pages with annotations should be output.
+    prefetch_pages: Number of pages (default 0) to load in background
+                    threads while the previous pages are rendered.  When
+                    this is not 0, the source's open and exists methods
+                    will be called from several threads at once.
     """
 
     vector=True  # TODO: Different rendering styles
@@ -101,19 +109,19 @@ def render(source, *,
 
     # Don't load all the pages into memory, because large notebooks
     # about 500 pages could use up to 3 GB of RAM. Create them by
-    # iteration so they get released by garbage collector.
+    # iteration so they get released by garbage collector. With
+    # prefetch_pages, only that many pages are loaded ahead of the
+    # rendering.
     changed_pages = []
     annotations = []
-    for i in range(0, len(pages)):
-        template_name = pages[i].get("template", {}).get("value", None)
-        page = document.DocumentPage(source, pages[i]["id"], i, template_name)
-        if page.version is not None:
-            version = page.version
-        if source.exists(page.rmpath):
-            changed_pages.append(i)
-        page.render_to_painter(pdf_canvas, vector, template_alpha)
-        annotations.append(page.get_grouped_annotations())
-        progress_cb((i + 1) / len(pages) * 50)
+    with closing(load_pages(source, pages, prefetch_pages)) as loaded_pages:
+        for i, page in enumerate(loaded_pages):
+            if page.version is not None:
+                version = page.version
+                changed_pages.append(i)
+            page.render_to_painter(pdf_canvas, vector, template_alpha)
+            annotations.append(page.get_grouped_annotations())
+            progress_cb((i + 1) / len(pages) * 50)
     pdf_canvas.save()
     tmpfh.seek(0)
 
@@ -209,6 +217,33 @@ def render(source, *,
     return stream
 
 
+def load_pages(source, pages, prefetch=0):
+    # Yield the DocumentPages in order. If prefetch is not 0, that many
+    # of the following pages are loaded by background threads.
+    template_names = document.read_template_names(source)
+    templates = document.TemplateCache()
+
+    def load_page(i):
+        template_name = pages[i].get("template", {}).get("value", None)
+        return document.DocumentPage(source, pages[i]["id"], i,
+                                     template_name, template_names,
+                                     templates)
+
+    if prefetch <= 0:
+        for i in range(len(pages)):
+            yield load_page(i)
+        return
+
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        pending = deque()
+        for i in range(len(pages)):
+            pending.append(executor.submit(load_page, i))
+            if len(pending) > prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 def do_apply_ocg(basepage, rmpage, i, uses_base_pdf, ocgprop, annotations):
     ocgpage = IndirectPdfDict(
         Type=PdfName('OCG'),
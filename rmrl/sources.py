@@ -30,6 +30,9 @@ In both cases, the filename may include the string `{ID}`, which indicates
 the Remarkable ID for that particular document (a UUID).  Thus, the caller
 of these methods does not have to know the ID of a document; the Source is
 responsible for filling that in appropriately.
+
+If render() is called with prefetch_pages, both methods may be called from
+several threads at once.
 """
 
 class FSSource: